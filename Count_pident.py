@@ -6,34 +6,285 @@ Author: Ankush Sharma (Ankush.Sharma@uga.edu)
 Plant Genome Mapping Laboratory, University of Georgia
 
 Usage:
-  python Count_pident.py <blast_outfmt6.tsv> <output_prefix>
+  python Count_pident.py <blast_outfmt6.tsv> <output_prefix> [--exact] [--workers N]
+or, from Python:
+  from Count_pident import run
+  run("<blast_outfmt6.tsv>", "<output_prefix>", workers=1)
 
 Produces:
   1) pident histogram -> <output_prefix>_pident_hist.txt
   2) cumulative distribution -> <output_prefix>_pident_cumulative.txt
-  3) prints total queries with hits to stdout
+  3) prints total queries with hits to stdout (exact up to EXACT_IDS_MAX
+     distinct queries, then a HyperLogLog estimate when datasketch is
+     installed; pass --exact to always count exactly)
+
+Files of PANDAS_MIN_BYTES or more are parsed in vectorized chunks when numpy
+and pandas are installed (with a Numba-compiled histogram kernel when numba
+is available); smaller files, or all files without them, go through a
+pure-Python line loop that finishes before those imports would. With
+--workers N > 1 the file is mmap'ed, cut into newline-aligned byte ranges
+and the ranges are counted in N processes.
 """
 
-import sys
-import math
-from collections import defaultdict
+import os
+import io
+import csv
+import mmap
+import argparse
+import warnings
 
-def main():
-    if len(sys.argv) < 3:
-        print(__doc__)
-        sys.exit(1)
 
-    blast_file = sys.argv[1]
-    out_prefix = sys.argv[2]
+# Optional heavy backends, imported only when a run needs them so that
+# importing this module (and small runs) stay cheap: numpy/pandas/numba by
+# _load_backends(), datasketch by _load_hyperloglog().
+np = None
+pd = None
+njit = None
+HyperLogLog = None
+_backends_loaded = False
+_hyperloglog_loaded = False
+
+# Inputs smaller than this are parsed by the pure-Python loop; importing
+# numpy/pandas/numba (~0.7 s) costs more than the vectorized parse saves.
+PANDAS_MIN_BYTES = 128 << 20
+
+# Distinct query IDs kept in an exact set before QueryCounter moves them
+# into a HyperLogLog sketch (~50 MB of bytes IDs at this size).
+EXACT_IDS_MAX = 500_000
+
+# Rows per read_csv chunk; keeps memory flat on very large DIAMOND outputs.
+CHUNK_ROWS = 1_000_000
+
+# Upper bound on the byte range one worker copies out of the mmap at a time.
+RANGE_BYTES = 64 << 20
+
+
+class QueryCounter:
+    """
+    Counts distinct query IDs. IDs are kept in a plain set until there are
+    more than EXACT_IDS_MAX of them, then moved into a HyperLogLog sketch
+    (~16 KB, <1% error); with exact=True, or without datasketch, the set
+    is kept throughout.
+    """
+
+    def __init__(self, exact=False):
+        self.exact = exact
+        self.approximate = False
+        self._ids = set()
+
+    def _to_sketch(self):
+        """
+        Moves the IDs collected so far into a HyperLogLog sketch, unless
+        exact counting was asked for or datasketch is not installed.
+        """
+        if self.exact or _load_hyperloglog() is None:
+            # Stay exact; also stops add() from trying again
+            self.exact = True
+            return
+        hll = HyperLogLog(p=14)
+        for qseqid in self._ids:
+            hll.update(qseqid)
+        self._ids = hll
+        self.approximate = True
+
+    def add(self, qseqid):
+        """
+        Adds one query ID. str IDs (from pandas) are stored as UTF-8 bytes,
+        like those of count_pident_python, so partial counters from either
+        parser hash and merge the same ID identically.
+        """
+        if isinstance(qseqid, str):
+            qseqid = qseqid.encode()
+        if self.approximate:
+            self._ids.update(qseqid)
+        else:
+            self._ids.add(qseqid)
+            if len(self._ids) > EXACT_IDS_MAX and not self.exact:
+                self._to_sketch()
+
+    def add_many(self, qseqids):
+        """
+        Adds an iterable of (already de-duplicated) query IDs.
+        """
+        for qseqid in qseqids:
+            self.add(qseqid)
+
+    def merge(self, other):
+        if other.approximate and not self.approximate:
+            self._to_sketch()
+        if not self.approximate:
+            self._ids |= other._ids
+            if len(self._ids) > EXACT_IDS_MAX and not self.exact:
+                self._to_sketch()
+        elif other.approximate:
+            self._ids.merge(other._ids)
+        else:
+            for qseqid in other._ids:
+                self._ids.update(qseqid)
+
+    def count(self):
+        if self.approximate:
+            return int(round(self._ids.count()))
+        return len(self._ids)
+
+
+def _hist(pid, out):
+    """
+    Adds each pident in pid to its floor bucket in out (length 101).
+    Values outside 0-100 (and NaN) are ignored.
+    """
+    for i in range(pid.shape[0]):
+        p = pid[i]
+        if p >= 0.0 and p < 101.0:
+            out[int(p)] += 1
+
 
-    pident_counts = defaultdict(int)
-    query_ids = set()
+def _load_backends():
+    """
+    Imports numpy/pandas (and numba, Numba-compiling _hist) once per process.
+    Called only for inputs that go to the pandas parser, so busco_diamond.py
+    pays the import cost once per worker rather than at module import.
+    """
+    global np, pd, njit, _hist, _backends_loaded
+    if _backends_loaded:
+        return
+    _backends_loaded = True
 
-    with open(blast_file, "r") as fh:
+    try:
+        import numpy
+        import pandas
+        np, pd = numpy, pandas
+    except ImportError:
+        np, pd = None, None
+
+    if np is not None:
+        try:
+            from numba import njit
+            _hist = njit(cache=True)(_hist)
+        except ImportError:
+            njit = None
+
+
+def _load_hyperloglog():
+    """
+    Imports datasketch's HyperLogLog once per process (~0.6 s) and returns
+    it, or None if datasketch is not installed.
+    """
+    global HyperLogLog, _hyperloglog_loaded
+    if not _hyperloglog_loaded:
+        _hyperloglog_loaded = True
+        try:
+            from datasketch import HyperLogLog
+        except ImportError:
+            HyperLogLog = None
+    return HyperLogLog
+
+
+def count_pident_pandas(source, exact=False):
+    """
+    Vectorized parse of the outfmt6 TSV (a path or binary file object)
+    with pandas' C reader. Skips the same rows as count_pident_python
+    ('#' lines, < 3 columns, unparseable pident); input pandas cannot
+    tokenize (e.g. an empty file, or a first data row with < 3 columns)
+    is handed to count_pident_python.
+    Returns (counts, queries): counts is a contiguous int64[101] array,
+    counts[i] the number of hits with floor(pident) == i; queries is a
+    QueryCounter.
+    """
+    _load_backends()
+    if isinstance(source, (str, os.PathLike)):
+        fh = open(source, "rb")
+    else:
+        fh = source
+    with fh:
+        start = fh.tell()
+        # read_csv takes the column count from the first row, so start it on data
+        while True:
+            pos = fh.tell()
+            if not fh.readline().startswith(b"#"):
+                fh.seek(pos)
+                break
+        try:
+            return _count_pandas_chunks(fh, exact)
+        except ValueError:
+            fh.seek(start)
+            return count_pident_python(fh, exact)
+
+
+def _count_pandas_chunks(fh, exact):
+    """
+    read_csv loop behind count_pident_pandas.
+    """
+    bins = np.zeros(101, dtype=np.int64)
+    queries = QueryCounter(exact)
+
+    # No comment="#": it would also cut rows at a '#' inside a qseqid.
+    # pident is left to pandas' float inference and only coerced when a
+    # chunk contains something non-numeric. na_filter=False keeps IDs such
+    # as "NA" (or an empty field) as strings, as the line parser sees them.
+    reader = pd.read_csv(fh, sep="\t", header=None, usecols=[0, 2],
+                         dtype={0: object}, quoting=csv.QUOTE_NONE,
+                         na_filter=False, engine="c", chunksize=CHUNK_ROWS)
+    # A stray '#' line mid-file makes that block of pident object dtype;
+    # it is coerced below, so pandas' DtypeWarning about it is just noise
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", pd.errors.DtypeWarning)
+        for chunk in reader:
+            # A short first data row leaves no pident column (pandas drops the
+            # missing usecols entry silently); let count_pident_pandas hand
+            # the file to the line-by-line parser
+            if 2 not in chunk.columns:
+                raise ValueError("fewer than 3 columns in the first data row")
+            qseqids = chunk[0].to_numpy()
+            pident = chunk[2]
+            if pident.dtype.kind not in "iuf":
+                pident = pd.to_numeric(pident, errors="coerce")
+            # Always a float32 array for the Numba kernel, whatever pandas inferred
+            pid = pident.to_numpy(dtype=np.float32, na_value=np.nan)
+
+            # Drop '#' lines that made it through with a numeric 3rd column;
+            # checking the distinct IDs of valid rows is far cheaper than every row
+            valid = ~np.isnan(pid)
+            comment_ids = [q for q in pd.unique(qseqids[valid]) if isinstance(q, str) and q[:1] == "#"]
+            if comment_ids:
+                pid[pd.Series(qseqids).isin(comment_ids).to_numpy()] = np.nan
+
+            if njit is not None:
+                _hist(pid, bins)
+            else:
+                floors = np.floor(pid[~np.isnan(pid)]).astype(np.int64)
+                floors = floors[(floors >= 0) & (floors <= 100)]
+                bins += np.bincount(floors, minlength=101)
+            counted = (pid >= 0) & (pid < 101)
+            queries.add_many(pd.unique(qseqids[counted]))
+
+    return bins, queries
+
+
+def count_pident_python(source, exact=False):
+    """
+    Pure-Python parser, for small inputs and when numpy/pandas are not
+    installed. source is a path or binary file object; lines are read as bytes
+    (no UTF-8 decoding) and query IDs stay bytes.
+    Returns (counts, queries) as for count_pident_pandas, with counts
+    as a plain 101-element list.
+    """
+    counts = [0] * 101
+    queries = QueryCounter(exact)
+    add_query = queries.add
+    # DIAMOND output is grouped by query, so only add when the ID changes
+    last_qseqid = None
+
+    if isinstance(source, (str, os.PathLike)):
+        fh = open(source, "rb")
+    else:
+        fh = source
+    with fh:
         for line in fh:
-            if line.startswith("#") or not line.strip():
+            # One split does the work; blank lines give < 3 columns
+            if line[:1] == b"#":
                 continue
-            cols = line.split("\t")
+            cols = line.split(b"\t", 3)
             if len(cols) < 3:
                 continue
             qseqid = cols[0]
@@ -41,31 +292,174 @@ def main():
                 pident = float(cols[2])
             except ValueError:
                 continue
+            # Same range as _hist; also rejects NaN and inf
+            if not 0 <= pident < 101:
+                continue
+
+            # pident >= 0 here, so int() is floor()
+            counts[int(pident)] += 1
+            if qseqid != last_qseqid:
+                add_query(qseqid)
+                last_qseqid = qseqid
 
-            pident_floor = int(math.floor(pident))
-            pident_counts[pident_floor] += 1
-            query_ids.add(qseqid)
+    return counts, queries
+
+
+def _use_pandas(n_bytes):
+    """
+    True if n_bytes of TSV are worth the pandas parser and it is installed.
+    """
+    if n_bytes < PANDAS_MIN_BYTES:
+        return False
+    _load_backends()
+    return pd is not None
+
+
+def count_pident(blast_file, exact=False):
+    """
+    Counts blast_file with the pandas parser if it is large enough and
+    pandas is available, else pure Python.
+    """
+    if _use_pandas(os.path.getsize(blast_file)):
+        return count_pident_pandas(blast_file, exact)
+    return count_pident_python(blast_file, exact)
+
+
+def byte_ranges(blast_file, n_ranges):
+    """
+    Splits blast_file into up to n_ranges (start, end) byte ranges, each
+    ending just after a newline so no row is cut in two.
+    """
+    size = os.path.getsize(blast_file)
+    if size == 0:
+        return []
+    with open(blast_file, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        bounds = [0]
+        for i in range(1, n_ranges):
+            nl = mm.find(b"\n", max(bounds[-1], i * size // n_ranges))
+            if nl == -1:
+                break
+            if nl + 1 < size:
+                bounds.append(nl + 1)
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _count_range(job):
+    """
+    Worker: counts one (blast_file, start, end, exact) byte range via mmap.
+    """
+    blast_file, start, end, exact = job
+    with open(blast_file, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        buf = io.BytesIO(mm[start:end])
+    if _use_pandas(end - start):
+        return count_pident_pandas(buf, exact)
+    return count_pident_python(buf, exact)
+
+
+def count_pident_parallel(blast_file, workers, exact=False):
+    """
+    Counts blast_file in newline-aligned byte ranges across worker processes
+    and sums the partial histograms / merges the query counters.
+    Returns counts as a plain list; the parent never needs numpy itself.
+    """
+    # Imported here: concurrent.futures.process pulls in multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_ranges = max(workers, os.path.getsize(blast_file) // RANGE_BYTES + 1)
+    jobs = [(blast_file, a, b, exact) for a, b in byte_ranges(blast_file, n_ranges)]
+
+    counts = [0] * 101
+    queries = QueryCounter(exact)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for part_counts, part_queries in ex.map(_count_range, jobs):
+            counts = [a + int(b) for a, b in zip(counts, part_counts)]
+            queries.merge(part_queries)
+    return counts, queries
+
+
+def run(blast_file, out_prefix, exact=False, workers=1):
+    """
+    Writes the pident histogram and cumulative files for blast_file.
+    Importable, so busco_diamond.py can call it in-process per genome.
+    exact=True counts distinct queries with a set however many there are;
+    workers > 1 parses the file in parallel byte ranges.
+    """
+    if workers > 1:
+        counts, queries = count_pident_parallel(blast_file, workers, exact)
+    else:
+        counts, queries = count_pident(blast_file, exact)
 
-    # Write histogram
     hist_file = f"{out_prefix}_pident_hist.txt"
+    cum_file = f"{out_prefix}_pident_cumulative.txt"
+    if np is not None and isinstance(counts, np.ndarray):
+        write_outputs_numpy(counts, hist_file, cum_file)
+    else:
+        write_outputs(counts, hist_file, cum_file)
+
+    print(f"\nCount_pident results for: {blast_file}")
+    approx = " (approx.)" if queries.approximate else ""
+    print(f"Total queries with hits: {queries.count()}{approx}")
+    print(f"Histogram: {hist_file}")
+    print(f"Cumulative: {cum_file}\n")
+
+
+def write_outputs_numpy(counts, hist_file, cum_file):
+    """
+    Writes the histogram and cumulative files from a counts array with
+    np.savetxt (C-level formatting). Only non-empty buckets are listed.
+    """
+    idx = np.nonzero(counts)[0]
+    np.savetxt(hist_file, np.column_stack([idx, counts[idx]]),
+               fmt="%d\t%d", header="pident\tcount", comments="")
+
+    idx_desc = idx[::-1]
+    cum = np.cumsum(counts[idx_desc])
+    np.savetxt(cum_file, np.column_stack([idx_desc, cum]),
+               fmt=">=%d\t%d", header="pident_threshold\tcumulative_hits", comments="")
+
+
+def write_outputs(counts, hist_file, cum_file):
+    """
+    Same as write_outputs_numpy for a plain counts list (no numpy).
+    """
+    # Write histogram (non-empty buckets, ascending)
     with open(hist_file, "w") as out:
         out.write("pident\tcount\n")
-        for pid_floor in sorted(pident_counts.keys()):
-            out.write(f"{pid_floor}\t{pident_counts[pid_floor]}\n")
+        for pid_floor, c in enumerate(counts):
+            if c:
+                out.write(f"{pid_floor}\t{c}\n")
 
-    # Write cumulative
-    cum_file = f"{out_prefix}_pident_cumulative.txt"
+    # Write cumulative (reverse prefix sum, descending)
     running_total = 0
     with open(cum_file, "w") as out:
         out.write("pident_threshold\tcumulative_hits\n")
-        for pid_floor in sorted(pident_counts.keys(), reverse=True):
-            running_total += pident_counts[pid_floor]
-            out.write(f">={pid_floor}\t{running_total}\n")
+        for pid_floor in range(100, -1, -1):
+            c = counts[pid_floor]
+            if c:
+                running_total += c
+                out.write(f">={pid_floor}\t{running_total}\n")
 
-    print(f"\nCount_pident results for: {blast_file}")
-    print(f"Total queries with hits: {len(query_ids)}")
-    print(f"Histogram: {hist_file}")
-    print(f"Cumulative: {cum_file}\n")
+
+# Optionally import the backends and JIT the kernel at import time, e.g. before
+# forking workers:  COUNT_PIDENT_PRECOMPILE=1
+if os.environ.get("COUNT_PIDENT_PRECOMPILE"):
+    _load_backends()
+    if njit is not None:
+        _hist(np.zeros(1, dtype=np.float32), np.zeros(101, dtype=np.int64))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pident histogram / cumulative distribution of a BLAST outfmt6 TSV.")
+    parser.add_argument("blast_file", help="BLAST/DIAMOND outfmt6 TSV.")
+    parser.add_argument("out_prefix", help="Prefix for the _pident_hist.txt / _pident_cumulative.txt outputs.")
+    parser.add_argument("--exact", action="store_true",
+                        help="Always count distinct queries exactly (set), never switching to HyperLogLog.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes used to parse the TSV in parallel byte ranges.")
+    args = parser.parse_args()
+
+    run(args.blast_file, args.out_prefix, exact=args.exact, workers=args.workers)
 
 if __name__ == "__main__":
     main()
@@ -13,12 +13,14 @@ This script:
   3) For each genome:
      - Runs BUSCO (genome mode).
      - Runs DIAMOND alignment of predicted proteins vs. D. melanogaster known proteins.
-     - Calls Count_pident.py to summarize pident distributions.
+     - Runs Count_pident (imported in-process) to summarize pident distributions.
      - Collects BUSCO completeness into a master_summary.tsv.
 
 Parallel usage:
   - Set --cpu for multi-threading on each genome 
-    (BUSCO and DIAMOND will use that many threads).
+    (BUSCO and DIAMOND run side by side and split these threads).
+  - Set --parallel_genomes to process several genomes at once
+    (total threads used ~ parallel_genomes * cpu).
   - For HPC clusters with SLURM, see the example sbatch script below.
 
 Usage (local run):
@@ -34,8 +36,15 @@ import subprocess
 import argparse
 import logging
 import re
+import signal
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 
+from diamond_core import make_db, iter_genomes, find_missing_files
+
+# BUSCO one-line summary, e.g. C:95.1%[S:94.0%,D:1.1%],F:1.2%,M:3.7%,n:5991
+BUSCO_SUMMARY_RE = re.compile(r"C:([\d\.]+)%\[S:([\d\.]+)%,D:([\d\.]+)%\],F:([\d\.]+)%,M:([\d\.]+)%,n:(\d+)")
+
 
 def setup_logging(logfile=None):
     """
@@ -62,6 +71,16 @@ def setup_logging(logfile=None):
     return logger
 
 
+def init_worker_logging(logfile=None):
+    """
+    ProcessPoolExecutor initializer: sets up logging in a worker that did not
+    inherit the parent's handlers (spawn/forkserver start methods).
+    Under fork the handlers are already there and are left as they are.
+    """
+    if not logging.getLogger().handlers:
+        setup_logging(logfile)
+
+
 def check_and_download_lineage(lineage_name):
     """
     Checks if the lineage folder (e.g., 'hymenoptera_odb10') exists locally.
@@ -88,9 +107,10 @@ def check_and_download_lineage(lineage_name):
     return lineage_name
 
 
-def run_busco(genome_fasta, output_prefix, lineage_path, cpu=4):
+def start_busco(genome_fasta, output_prefix, lineage_path, cpu=4):
     """
-    Runs BUSCO in 'genome' mode using the specified lineage_path.
+    Starts BUSCO in 'genome' mode using the specified lineage_path.
+    Returns the Popen handle; pass it to wait_for() to finish.
     """
     cmd = [
         "busco",
@@ -101,7 +121,29 @@ def run_busco(genome_fasta, output_prefix, lineage_path, cpu=4):
         f"--cpu={cpu}"
     ]
     logging.info("Running BUSCO with command:\n  " + " ".join(cmd))
-    subprocess.run(cmd, check=True)
+    # Own process group, so kill_process_group() also stops hmmer/metaeuk children
+    return subprocess.Popen(cmd, start_new_session=True)
+
+
+def kill_process_group(proc):
+    """
+    Kills a Popen started with start_new_session=True, including the tools
+    it spawned, and reaps it.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def wait_for(proc):
+    """
+    Waits for a Popen started by start_busco/start_diamond_align and raises
+    CalledProcessError on a non-zero exit, like subprocess.run(check=True).
+    """
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
 
 def parse_busco_summary(prefix):
@@ -124,60 +166,138 @@ def parse_busco_summary(prefix):
         logging.warning(f"BUSCO summary file not found: {summary_file}")
         return stats
 
-    pattern = r"C:([\d\.]+)%\[S:([\d\.]+)%,D:([\d\.]+)%\],F:([\d\.]+)%,M:([\d\.]+)%,n:(\d+)"
     with open(summary_file, "r") as f:
         for line in f:
-            if "C:" in line and "S:" in line and "D:" in line and "n:" in line:
-                match = re.search(pattern, line)
-                if match:
-                    stats["Complete(%)"]   = float(match.group(1))
-                    stats["Single(%)"]     = float(match.group(2))
-                    stats["Duplicated(%)"] = float(match.group(3))
-                    stats["Fragmented(%)"] = float(match.group(4))
-                    stats["Missing(%)"]    = float(match.group(5))
-                    stats["TotalBUSCO"]    = int(match.group(6))
+            match = BUSCO_SUMMARY_RE.search(line)
+            if not match:
+                continue
+            stats["Complete(%)"]   = float(match.group(1))
+            stats["Single(%)"]     = float(match.group(2))
+            stats["Duplicated(%)"] = float(match.group(3))
+            stats["Fragmented(%)"] = float(match.group(4))
+            stats["Missing(%)"]    = float(match.group(5))
+            stats["TotalBUSCO"]    = int(match.group(6))
+            # Only one summary line per file
+            break
     return stats
 
 
-def diamond_align(dmel_faa, query_faa, out_tsv, cpu=4):
+def start_diamond_align(db_prefix, query_faa, out_tsv, cpu=4):
     """
-    Uses DIAMOND to align query_faa (predicted proteins) 
-    against dmel_faa (D. melanogaster known proteins).
+    Starts DIAMOND blastp to align query_faa (predicted proteins) 
+    against the D. melanogaster database built by diamond_core.make_db.
+    Returns the Popen handle; pass it to wait_for() to finish.
     """
-    # Step 1: Make the DIAMOND database 
-    cmd_db = [
-        "diamond", "makedb",
-        "--in", dmel_faa,
-        "-d", "dmel_db"
-    ]
-    logging.info("Creating DIAMOND DB:\n  " + " ".join(cmd_db))
-    subprocess.run(cmd_db, check=True)
-
-    # Step 2: DIAMOND blastp
     cmd_blast = [
         "diamond", "blastp",
-        "--db", "dmel_db.dmnd",
+        "--db", f"{db_prefix}.dmnd",
         "--query", query_faa,
         "--out", out_tsv,
         "--outfmt", "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore",
         "--threads", str(cpu)
     ]
     logging.info("DIAMOND alignment:\n  " + " ".join(cmd_blast))
-    subprocess.run(cmd_blast, check=True)
+    return subprocess.Popen(cmd_blast)
 
 
 def run_count_pident(blast_tsv, out_prefix):
     """
-    Calls Count_pident.py on the BLAST/DIAMOND TSV to generate 
+    Runs Count_pident in-process on the BLAST/DIAMOND TSV to generate 
     histogram and cumulative distribution of pident.
     """
-    script = "./Count_pident.py"
-    if not os.path.exists(script):
-        logging.warning(f"Count_pident.py not found at {script}. Skipping pident analysis.")
+    try:
+        from Count_pident import run as count_pident_run
+    except ImportError:
+        logging.warning("Count_pident.py not importable (keep it next to this script). Skipping pident analysis.")
         return
-    cmd = ["python", script, blast_tsv, out_prefix]
-    logging.info("Running Count_pident.py:\n  " + " ".join(cmd))
-    subprocess.run(cmd, check=True)
+    logging.info(f"Running Count_pident on {blast_tsv} -> {out_prefix}_pident_*.txt")
+    count_pident_run(blast_tsv, out_prefix)
+
+
+def process_genome(job):
+    """
+    Runs BUSCO, DIAMOND and Count_pident for a single genome.
+    BUSCO and DIAMOND have no data dependency, so they run side by side,
+    splitting cpu threads between them.
+    job is (genome_id, genome_fasta, proteins_faa, has_proteins, busco_prefix,
+    lineage_path, db_prefix, cpu); has_proteins comes from the parent's batch check.
+    Returns (genome_id, stats) so the parent can write master_summary.tsv.
+    """
+    (genome_id, genome_fasta, proteins_faa, has_proteins, busco_prefix,
+     lineage_path, db_prefix, cpu) = job
+
+    logging.info(f"\nProcessing genome: {genome_id}")
+    logging.info(f"  Genome FASTA = {genome_fasta}")
+    logging.info(f"  Proteins FASTA = {proteins_faa}")
+    logging.info(f"  BUSCO prefix = {busco_prefix}")
+
+    # Split threads between the two tools when both run
+    busco_cpu = max(1, cpu // 2) if has_proteins else cpu
+    diamond_cpu = max(1, cpu - busco_cpu)
+
+    # --- BUSCO and DIAMOND alignment, overlapped ---
+    busco_proc = start_busco(genome_fasta, busco_prefix, lineage_path=lineage_path, cpu=busco_cpu)
+    diamond_out = f"{busco_prefix}_diamond.tsv"
+    try:
+        if has_proteins:
+            diamond_proc = start_diamond_align(db_prefix, proteins_faa, diamond_out, cpu=diamond_cpu)
+            wait_for(diamond_proc)
+        else:
+            logging.warning(f"Proteins file not found: {proteins_faa}")
+        wait_for(busco_proc)
+    except BaseException:
+        # BUSCO is in its own session, so neither a DIAMOND failure nor Ctrl-C
+        # reaches it; stop it here and report the original error
+        kill_process_group(busco_proc)
+        raise
+
+    # --- Parse BUSCO results ---
+    stats = parse_busco_summary(busco_prefix)
+
+    # --- pident distribution ---
+    if has_proteins:
+        run_count_pident(diamond_out, f"{busco_prefix}_pident")
+
+    return genome_id, stats
+
+
+def run_in_order(ex, fn, jobs, max_in_flight):
+    """
+    Yields fn(job) for each job in list order, with at most max_in_flight
+    jobs submitted to ex at a time, so later genomes are only started as
+    earlier ones finish. After the first failure nothing new is started:
+    genomes already running finish, results before the failed genome are
+    still yielded, then the error is re-raised.
+    """
+    pending = {}
+    results = {}
+    error = None
+    next_job = 0
+    next_out = 0
+    try:
+        while next_out < len(jobs):
+            while error is None and next_job < len(jobs) and len(pending) < max_in_flight:
+                pending[ex.submit(fn, jobs[next_job])] = next_job
+                next_job += 1
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx = pending.pop(fut)
+                try:
+                    results[idx] = fut.result()
+                except Exception as e:
+                    if error is None or idx < error[0]:
+                        error = (idx, e)
+            while next_out in results:
+                yield results.pop(next_out)
+                next_out += 1
+    except BaseException:
+        ex.shutdown(wait=False, cancel_futures=True)
+        raise
+    if error is not None:
+        ex.shutdown(wait=False, cancel_futures=True)
+        raise error[1]
 
 
 def main():
@@ -192,6 +312,10 @@ def main():
                         help="Path to D. melanogaster known proteins FASTA.")
     parser.add_argument("--cpu", type=int, default=4,
                         help="Number of threads for BUSCO/DIAMOND.")
+    parser.add_argument("--parallel_genomes", type=int, default=1,
+                        help="Number of genomes to process concurrently (each uses --cpu threads).")
+    parser.add_argument("--no_db_cache", action="store_true",
+                        help="Always rebuild the DIAMOND DB instead of reusing one cached by FASTA hash.")
     parser.add_argument("--log", default="minimal_pipeline.log",
                         help="Log file name.")
     args = parser.parse_args()
@@ -202,59 +326,48 @@ def main():
     # 1) Check or download the lineage dataset
     lineage_path = check_and_download_lineage(args.lineage)
 
-    # 2) Prepare master summary
-    out_summary = open("master_summary.tsv", "w")
-    out_summary.write("GenomeID\tComplete(%)\tSingle(%)\tDuplicated(%)\tFragmented(%)\tMissing(%)\tTotalBUSCO\n")
-
-    # 3) Read the genome list
+    # 2) Read the genome list
     if not os.path.exists(args.genome_list):
         logger.error(f"Genome list file not found: {args.genome_list}")
         sys.exit(1)
 
-    with open(args.genome_list, "r") as fh:
-        for line in fh:
-            if not line.strip() or line.strip().startswith("#"):
-                continue
-            parts = line.strip().split()
-            if len(parts) < 3:
-                logger.warning("Skipping line with too few columns:\n" + line)
-                continue
-
-            genome_id   = parts[0]
-            genome_fasta= parts[1]
-            proteins_faa= parts[2]
-            if len(parts) > 3:
-                busco_prefix = parts[3]
-            else:
-                busco_prefix = genome_id
-
-            logger.info(f"\nProcessing genome: {genome_id}")
-            logger.info(f"  Genome FASTA = {genome_fasta}")
-            logger.info(f"  Proteins FASTA = {proteins_faa}")
-            logger.info(f"  BUSCO prefix = {busco_prefix}")
-
-            # --- BUSCO ---
-            run_busco(genome_fasta, busco_prefix, lineage_path=lineage_path, cpu=args.cpu)
-
-            # --- Parse BUSCO results ---
-            stats = parse_busco_summary(busco_prefix)
-
-            # --- DIAMOND alignment ---
-            if os.path.exists(proteins_faa):
-                diamond_out = f"{busco_prefix}_diamond.tsv"
-                diamond_align(args.dmel_faa, proteins_faa, diamond_out, cpu=args.cpu)
-                # --- pident distribution ---
-                run_count_pident(diamond_out, f"{busco_prefix}_pident")
-            else:
-                logger.warning(f"Proteins file not found: {proteins_faa}")
-
-            # Write stats
+    # 3) Build the DIAMOND database once, shared by all genomes
+    db_prefix = make_db(args.dmel_faa, "dmel_db", use_cache=not args.no_db_cache)
+
+    jobs = []
+    for parts in iter_genomes(args.genome_list, min_cols=3):
+        genome_id   = parts[0]
+        genome_fasta= parts[1]
+        proteins_faa= parts[2]
+        if len(parts) > 3:
+            busco_prefix = parts[3]
+        else:
+            busco_prefix = genome_id
+
+        jobs.append((genome_id, genome_fasta, proteins_faa, busco_prefix))
+
+    # Check all proteins files in one batch instead of one stat per genome
+    missing = find_missing_files(job[2] for job in jobs)
+    jobs = [(genome_id, genome_fasta, proteins_faa, proteins_faa not in missing,
+             busco_prefix, lineage_path, db_prefix, args.cpu)
+            for genome_id, genome_fasta, proteins_faa, busco_prefix in jobs]
+
+    # Tools already get --cpu threads each; keep OpenMP from adding more
+    if args.parallel_genomes > 1:
+        os.environ["OMP_NUM_THREADS"] = "1"
+
+    # 4) Process genomes; only the parent writes the master summary
+    n_workers = max(1, args.parallel_genomes)
+    with open("master_summary.tsv", "w") as out_summary, \
+            ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker_logging,
+                                initargs=(args.log,)) as ex:
+        out_summary.write("GenomeID\tComplete(%)\tSingle(%)\tDuplicated(%)\tFragmented(%)\tMissing(%)\tTotalBUSCO\n")
+        for genome_id, stats in run_in_order(ex, process_genome, jobs, n_workers):
             out_summary.write(
                 f"{genome_id}\t{stats['Complete(%)']}\t{stats['Single(%)']}\t{stats['Duplicated(%)']}\t"
                 f"{stats['Fragmented(%)']}\t{stats['Missing(%)']}\t{stats['TotalBUSCO']}\n"
             )
 
-    out_summary.close()
     elapsed = datetime.now() - start_time
     logger.info(f"\nAll genomes processed! Total pipeline time: {elapsed}\n")
 
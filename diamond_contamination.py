@@ -12,10 +12,15 @@ Description:
 
 It reads a TSV file (genome_list.tsv) with two columns:
   GenomeID   /path/to/genome.fna
-ignoring lines beginning with '#'.
+ignoring lines beginning with '#'. With --proteins_column N, column N may give
+predicted proteins (e.g. the ProteinsFaa column used by busco_diamond.py);
+those genomes are searched with diamond blastp instead of blastx, and qseqid
+is then the protein ID rather than the contig.
 
 For each genome in the list:
-  - Runs diamond blastx --db <ref>.dmnd --query <genome>.fna
+  - Runs diamond blastx --db <ref>.dmnd --query <genome>.fna, or
+    diamond blastp --db <ref>.dmnd --query <proteins>.faa when --proteins_column
+    gives an existing proteins file for that genome
   - Merges hits into one output file, prefixing each line with:
       <GenomeID> <ContaminantLabel> qseqid sseqid pident ...
 
@@ -29,8 +34,12 @@ Usage:
 
 Steps:
   1) Optionally download <ref_faa> if not present (via --download_url).
-  2) Makes a diamond DB from <ref_faa>.
-  3) Loops over the genome list, runs diamond blastx, compiles all hits.
+  2) Makes a diamond DB from <ref_faa>, or reuses the one cached for the same
+     FASTA content in ~/.cache/genome_qc (override with $GENOME_QC_CACHE).
+  3) Loops over the genome list, runs diamond blastx (or blastp on predicted
+     proteins), compiles all hits.
+
+The DIAMOND and genome-list helpers live in diamond_core.py.
 
 """
 
@@ -41,6 +50,8 @@ import argparse
 import logging
 from datetime import datetime
 
+from diamond_core import make_db, stream_blastx, stream_blastp, iter_genomes, find_missing_files
+
 def setup_logging():
     logging.basicConfig(
         level=logging.INFO,
@@ -65,31 +76,6 @@ def maybe_download_ref_faa(ref_faa, url=None):
         logging.error("Download failed or file missing after download.")
         sys.exit(1)
 
-def make_diamond_db(ref_faa, db_prefix):
-    """
-    Create a DIAMOND database from the protein FASTA.
-    """
-    cmd = ["diamond", "makedb", "--in", ref_faa, "-d", db_prefix]
-    logging.info("Creating DIAMOND DB:\n  " + " ".join(cmd))
-    subprocess.run(cmd, check=True)
-
-def run_diamond_blastx(genome_fasta, db_prefix, threads=1):
-    """
-    Runs diamond blastx on a single genome, returning lines in outfmt 6.
-    """
-    cmd = [
-        "diamond", "blastx",
-        "--db", f"{db_prefix}.dmnd",
-        "--query", genome_fasta,
-        "--outfmt", "6",
-        "--threads", str(threads),
-        "--evalue", "1e-5"
-    ]
-    logging.info(f"Running DIAMOND on {genome_fasta}:\n  {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-    lines = result.stdout.strip().split("\n")
-    return [l for l in lines if l.strip()]
-
 def main():
     setup_logging()
     parser = argparse.ArgumentParser(description="DIAMOND-based contamination screen for multiple genomes.")
@@ -105,6 +91,11 @@ def main():
                         help="Label added to each line to indicate the reference (e.g. 'univec' or 'phix').")
     parser.add_argument("--download_url", default=None,
                         help="Optional: if ref_faa is missing, download from this URL.")
+    parser.add_argument("--no_db_cache", action="store_true",
+                        help="Always rebuild the DIAMOND DB instead of reusing one cached by FASTA hash.")
+    parser.add_argument("--proteins_column", type=int, default=None,
+                        help="Optional: 1-based genome_list column with predicted proteins FASTA (e.g. 3). "
+                             "Where present, run blastp on those proteins instead of blastx on the genome.")
     args = parser.parse_args()
 
     start_time = datetime.now()
@@ -113,46 +104,47 @@ def main():
     maybe_download_ref_faa(args.ref_faa, args.download_url)
 
     # Build diamond db
-    db_prefix = "tmp_contaminant_db"
-    make_diamond_db(args.ref_faa, db_prefix)
+    db_prefix = make_db(args.ref_faa, "tmp_contaminant_db", use_cache=not args.no_db_cache)
 
     # Validate genome list
     if not os.path.isfile(args.genome_list):
         logging.error(f"Genome list '{args.genome_list}' not found.")
         sys.exit(1)
 
-    # Prepare output, add a header if you wish
-    header = "GenomeID\tContaminant\tqseqid\tsseqid\tpident\tlength\tmismatch\tgapopen\tqstart\tqend\tsstart\tsend\tevalue\tbitscore"
-    with open(args.out, "w") as fout:
-        fout.write(header + "\n")
+    # Read genome_list, then check all genome (and proteins) paths in one batch
+    pcol = args.proteins_column
+    genomes = []
+    for parts in iter_genomes(args.genome_list, min_cols=2):
+        proteins_path = parts[pcol - 1] if pcol and len(parts) >= pcol else None
+        genomes.append((parts[0], parts[1], proteins_path))
+
+    missing = find_missing_files([g[1] for g in genomes] + [g[2] for g in genomes if g[2]])
 
     total_hits = 0
 
-    # Loop over each line in genome_list
-    with open(args.genome_list, "r") as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            parts = line.split()
-            if len(parts) < 2:
-                logging.warning(f"Skipping line (not enough cols): {line}")
-                continue
+    # Open output once (1 MB buffer), add a header if you wish
+    header = "GenomeID\tContaminant\tqseqid\tsseqid\tpident\tlength\tmismatch\tgapopen\tqstart\tqend\tsstart\tsend\tevalue\tbitscore"
+    with open(args.out, "w", buffering=1 << 20) as fout:
+        fout.write(header + "\n")
 
-            genome_id = parts[0]
-            genome_path = parts[1]
-            if not os.path.isfile(genome_path):
+        for genome_id, genome_path, proteins_path in genomes:
+            prefix_fields = (genome_id, args.contaminant_label)
+            if proteins_path and proteins_path in missing:
+                logging.warning(f"Proteins file {proteins_path} not found for {genome_id}; "
+                                f"falling back to blastx on the genome.")
+                proteins_path = None
+            if proteins_path:
+                logging.info(f"=== Processing {genome_id} (proteins, blastp) with reference '{args.contaminant_label}' ===")
+                n_hits = stream_blastp(proteins_path, db_prefix, args.threads, fout, prefix_fields)
+            elif genome_path in missing:
                 logging.warning(f"Genome file {genome_path} not found for {genome_id}. Skipping.")
                 continue
+            else:
+                logging.info(f"=== Processing {genome_id} with reference '{args.contaminant_label}' ===")
+                n_hits = stream_blastx(genome_path, db_prefix, args.threads, fout, prefix_fields)
+            logging.info(f"Found {n_hits} hits for {genome_id}")
 
-            logging.info(f"=== Processing {genome_id} with reference '{args.contaminant_label}' ===")
-            hits = run_diamond_blastx(genome_path, db_prefix, threads=args.threads)
-            logging.info(f"Found {len(hits)} hits for {genome_id}")
-
-            total_hits += len(hits)
-            with open(args.out, "a") as fout:
-                for h in hits:
-                    fout.write(f"{genome_id}\t{args.contaminant_label}\t{h}\n")
+            total_hits += n_hits
 
     elapsed = datetime.now() - start_time
     logging.info(f"Done. Wrote {total_hits} total hits to {args.out}. Elapsed time: {elapsed}.")
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+diamond_core.py
+
+Author: Ankush Sharma (Ankush.Sharma@uga.edu)
+Plant Genome Mapping Laboratory, UGA
+
+Shared DIAMOND / genome-list helpers imported by diamond_contamination.py
+and busco_diamond.py:
+  - make_db             build (or reuse a cached) DIAMOND database from a protein FASTA
+  - stream_blastx       run diamond blastx on a genome, streaming prefixed hits
+  - stream_blastp       same, but diamond blastp on predicted proteins
+  - iter_genomes        iterate the rows of a genome_list TSV
+  - find_missing_files  batch existence check for input paths
+"""
+
+import os
+import hashlib
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Where content-addressed DIAMOND databases are kept between runs
+DB_CACHE_DIR = Path(os.environ.get("GENOME_QC_CACHE", Path.home() / ".cache" / "genome_qc"))
+
+
+def sha256_file(path):
+    """
+    SHA-256 hex digest of a file, read in 1 MB chunks.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_db(ref_faa, prefix, use_cache=True):
+    """
+    Create a DIAMOND database from the protein FASTA and return its prefix.
+    With use_cache, the database is stored as <DB_CACHE_DIR>/<sha256>.dmnd and
+    reused by later runs on the same FASTA content; otherwise <prefix>.dmnd.
+    """
+    if use_cache:
+        DB_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cached = DB_CACHE_DIR / sha256_file(ref_faa)
+        if cached.with_suffix(".dmnd").is_file():
+            logging.info(f"Reusing cached DIAMOND DB for {ref_faa}: {cached}.dmnd")
+            return str(cached)
+        # Build under a temporary name so concurrent runs never see a partial db
+        tmp = f"{cached}.tmp{os.getpid()}"
+        cmd = ["diamond", "makedb", "--in", ref_faa, "-d", tmp]
+        logging.info("Creating DIAMOND DB:\n  " + " ".join(cmd))
+        subprocess.run(cmd, check=True)
+        os.replace(f"{tmp}.dmnd", f"{cached}.dmnd")
+        return str(cached)
+
+    cmd = ["diamond", "makedb", "--in", ref_faa, "-d", prefix]
+    logging.info("Creating DIAMOND DB:\n  " + " ".join(cmd))
+    subprocess.run(cmd, check=True)
+    return prefix
+
+
+def stream_diamond(mode, query_fa, db_prefix, threads, out_fh, prefix_fields):
+    """
+    Runs diamond <mode> (blastx or blastp) on query_fa, streaming its outfmt 6
+    lines straight into out_fh, each prefixed with the tab-joined prefix_fields.
+    Returns the number of hits written.
+    """
+    cmd = [
+        "diamond", mode,
+        "--db", f"{db_prefix}.dmnd",
+        "--query", query_fa,
+        "--outfmt", "6",
+        "--threads", str(threads),
+        "--evalue", "1e-5"
+    ]
+    logging.info(f"Running DIAMOND on {query_fa}:\n  {' '.join(cmd)}")
+    line_prefix = "".join(f"{field}\t" for field in prefix_fields)
+    n_hits = 0
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, bufsize=1 << 20) as proc:
+        for line in proc.stdout:
+            if not line.strip():
+                continue
+            if not line.endswith("\n"):
+                line += "\n"
+            out_fh.write(line_prefix + line)
+            n_hits += 1
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return n_hits
+
+
+def stream_blastx(genome_fa, db_prefix, threads, out_fh, prefix_fields):
+    """
+    Six-frame translated search of a nucleotide genome (see stream_diamond).
+    """
+    return stream_diamond("blastx", genome_fa, db_prefix, threads, out_fh, prefix_fields)
+
+
+def stream_blastp(proteins_faa, db_prefix, threads, out_fh, prefix_fields):
+    """
+    Protein search of already-predicted proteins (see stream_diamond);
+    about 6x less work than blastx on the genome.
+    """
+    return stream_diamond("blastp", proteins_faa, db_prefix, threads, out_fh, prefix_fields)
+
+
+def iter_genomes(tsv_path, min_cols=2):
+    """
+    Yields the whitespace-split columns of each row in a genome_list TSV,
+    skipping blank lines and '#' comments. Rows with fewer than min_cols
+    columns are logged and skipped.
+    """
+    with open(tsv_path, "r") as fh:
+        for line in fh:
+            # split() already drops surrounding whitespace; no separate strip()
+            parts = line.split()
+            if not parts or parts[0][0] == "#":
+                continue
+            if len(parts) < min_cols:
+                logging.warning(f"Skipping line (not enough cols): {line.strip()}")
+                continue
+            yield parts
+
+
+def find_missing_files(paths, workers=32):
+    """
+    Stats all paths up front (in a thread pool, since stat is I/O bound on NFS)
+    and returns the set of those that are not regular files.
+    """
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        found = ex.map(os.path.isfile, paths)
+    return {p for p, ok in zip(paths, found) if not ok}